@@ -1,23 +1,43 @@
 import os
 import json
-import requests
+import time
+import httpx
+import asyncio
+import tiktoken
+import sqlite3
+import hmac
+import hashlib
 import logging
-from urllib.parse import urlparse
-from flask import Flask, request, render_template_string
-from openai import OpenAI
+from functools import lru_cache
+from logging.handlers import WatchedFileHandler
+from cachetools import TTLCache
+from urllib.parse import urlparse, quote
+from quart import Quart, request, render_template_string, jsonify
+from openai import AsyncOpenAI
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
 
 # Configuración de logging
+# Con varios workers de hypercorn todos escriben al mismo archivo: WatchedFileHandler solo agrega
+# líneas y reabre el archivo cuando una herramienta externa (logrotate) lo rota. LOG_FILE vacío
+# deshabilita el archivo y deja solo la consola.
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+log_handlers = [logging.StreamHandler()]
+if LOG_FILE:
+    log_handlers.append(WatchedFileHandler(LOG_FILE))
+
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
+    handlers=log_handlers
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 # Validación de variables de entorno
 def validate_environment():
@@ -39,26 +59,472 @@ def validate_environment():
 gitlab_token = os.environ.get("GITLAB_TOKEN")
 gitlab_url = os.environ.get("GITLAB_URL")
 
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Transporte que reintenta con backoff exponencial las respuestas 502/503/504 de GitLab.
+    Como urllib3.Retry, solo reintenta métodos idempotentes para no duplicar comentarios.
+    """
+    RETRY_STATUS_CODES = {502, 503, 504}
+    RETRY_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+    def __init__(self, transport, total=3, backoff_factor=0.3):
+        self.transport = transport
+        self.total = total
+        self.backoff_factor = backoff_factor
+
+    async def handle_async_request(self, request):
+        attempt = 0
+        while True:
+            response = await self.transport.handle_async_request(request)
+            if (
+                response.status_code not in self.RETRY_STATUS_CODES
+                or request.method not in self.RETRY_METHODS
+                or attempt >= self.total
+            ):
+                return response
+
+            await response.aclose()
+            delay = self.backoff_factor * (2 ** attempt)
+            attempt += 1
+            logger.warning(
+                f"GitLab respondió {response.status_code} en {request.method} {request.url}; "
+                f"reintento {attempt}/{self.total} en {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+# Cliente HTTP asíncrono compartido para todas las llamadas a GitLab (reutiliza conexiones TCP/TLS).
+# Los errores de conexión los reintenta el transporte de httpx; los 502/503/504, RetryTransport.
+gitlab_client = httpx.AsyncClient(
+    headers={"Private-Token": gitlab_token or ""},
+    timeout=httpx.Timeout(30.0),
+    transport=RetryTransport(
+        httpx.AsyncHTTPTransport(
+            retries=3,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    ),
+)
+
+
+def gitlab_headers(private_token=None):
+    """Headers adicionales para GitLab: solo sobrescribe el token de la sesión si se indica otro."""
+    return {"Private-Token": private_token} if private_token else None
+
 # Inicializar cliente de OpenAI para Responses API
+OPENAI_TIMEOUT = 60
+OPENAI_MAX_RETRIES = 2
+
 def get_openai_client():
-    """Inicializa y retorna el cliente de OpenAI configurado para Responses API"""
+    """Inicializa y retorna el cliente asíncrono de OpenAI configurado para Responses API"""
     api_key = os.environ.get("OPENAI_API_KEY")
     api_base = os.environ.get("AZURE_OPENAI_API_BASE")
     api_version = os.environ.get("AZURE_OPENAI_API_VERSION")
     
     if api_base is not None:
         logger.info(f"Usando Azure OpenAI con base URL: {api_base}")
-        return OpenAI(
+        return AsyncOpenAI(
             api_key=api_key,
             base_url=api_base,
-            default_headers={"api-version": api_version} if api_version else None
+            default_headers={"api-version": api_version} if api_version else None,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=OPENAI_MAX_RETRIES,
         )
     else:
-        return OpenAI(api_key=api_key)
+        return AsyncOpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
 
-# Cliente global de OpenAI (se inicializa cuando se necesita)
+# Cliente global de OpenAI, compartido por todas las solicitudes (reutiliza su pool de conexiones)
 openai_client = get_openai_client()
 
+
+# Límite de tokens de entrada: prompts más largos se truncan localmente antes de llamar a la API
+MAX_INPUT_TOKENS = int(os.environ.get("MAX_INPUT_TOKENS", 12_000))
+TOKEN_TRUNCATION_MARKER = "\n...[truncated]..."
+
+# Límites de tamaño del diff enviado al modelo, para acotar tokens y latencia en MRs grandes
+MAX_DIFF_CHARS = int(os.environ.get("MAX_DIFF_CHARS", 60_000))
+MAX_DIFF_CHARS_PER_FILE = int(os.environ.get("MAX_DIFF_CHARS_PER_FILE", 8_000))
+DIFF_TRUNCATION_MARKER = "\n...[truncated]...\n"
+
+
+@lru_cache(maxsize=None)
+def get_token_encoding(model):
+    """
+    Retorna el tokenizer de tiktoken para el modelo. Si no lo reconoce o no se puede cargar, usa
+    cl100k_base; retorna None solo si tampoco se puede cargar cl100k_base (por ejemplo, sin acceso
+    para descargar el vocabulario).
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as e:
+        logger.warning(f"No se pudo cargar el tokenizer para {model}; se usa cl100k_base: {e}")
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"No se pudo cargar el tokenizer cl100k_base; no se contarán tokens: {e}")
+        return None
+
+
+def count_tokens(model, text):
+    """Cuenta tokens con tiktoken, o los estima (~4 caracteres por token) si no hay tokenizer."""
+    encoding = get_token_encoding(model)
+    return len(encoding.encode(text, disallowed_special=())) if encoding is not None else len(text) // 4
+
+
+def truncate_to_tokens(model, text, max_tokens, marker=TOKEN_TRUNCATION_MARKER):
+    """Recorta el texto a max_tokens tokens (o ~4 caracteres por token si no hay tokenizer)."""
+    encoding = get_token_encoding(model)
+    if encoding is None:
+        return text if len(text) <= max_tokens * 4 else text[:max_tokens * 4] + marker
+    # disallowed_special=(): un diff puede contener texto como "<|endoftext|>"
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens]) + marker
+
+
+def fit_input_to_token_limit(model, input_text):
+    """
+    Cuenta los tokens del input y, si superan MAX_INPUT_TOKENS, lo trunca por el final
+    (donde está el diff). Es solo una red de seguridad: los diffs ya se acotan en tokens al armar
+    el prompt (ver build_bounded_diff_parts). Sin tokenizer, estima ~4 caracteres por token.
+    """
+    input_tokens = count_tokens(model, input_text)
+    logger.info(f"Modelo: {model} - tokens de entrada: {input_tokens}")
+    if input_tokens <= MAX_INPUT_TOKENS:
+        return input_text
+
+    logger.warning(f"El input supera {MAX_INPUT_TOKENS} tokens; se trunca antes de enviarlo a OpenAI")
+    return truncate_to_tokens(model, input_text, MAX_INPUT_TOKENS)
+
+
+async def stream_openai_response(model, instructions, input_text):
+    """Genera una respuesta con la API de Responses en modo streaming.
+
+    Acumula los fragmentos de texto a medida que llegan y retorna (texto, usage).
+    """
+    input_text = fit_input_to_token_limit(model, input_text)
+    chunks = []
+    usage = None
+    stream = await openai_client.responses.create(
+        model=model,
+        input=input_text,
+        instructions=instructions,
+        stream=True,
+    )
+    # async with cierra la respuesta HTTP también si se lanza un error o se cancela la tarea
+    async with stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                chunks.append(event.delta)
+            elif event.type == "response.completed":
+                usage = event.response.usage
+            elif event.type == "response.incomplete":
+                # Respuesta cortada (p. ej. max_output_tokens): no se publica ni se guarda en caché
+                details = event.response.incomplete_details
+                reason = details.reason if details else "desconocido"
+                logger.warning(f"Respuesta de OpenAI incompleta (motivo: {reason})")
+                raise RuntimeError(f"Respuesta de OpenAI incompleta: {reason}")
+            elif event.type in ("response.failed", "error"):
+                raise RuntimeError(f"Streaming de OpenAI fallido: {event}")
+    return "".join(chunks), usage
+
+
+def tokens_match(received_token, expected_token):
+    """Compara tokens en tiempo constante para no filtrar información por timing."""
+    return hmac.compare_digest((received_token or "").encode("utf-8"), (expected_token or "").encode("utf-8"))
+
+
+# Prompts (en español). Se construyen una sola vez: solo el diff varía entre solicitudes, y el
+# texto fijo va primero para aprovechar el cacheo de prefijos del proveedor.
+MR_INSTRUCTIONS = (
+    "Eres un desarrollador senior especializado en arquitectura de software, revisando cambios de "
+    "código con enfoque en arquitectura hexagonal, separación de responsabilidades, orientación a "
+    "objetos y mejores prácticas de desarrollo. Responde en markdown compatible con GitLab. "
+    "Incluye una versión concisa de cada pregunta en tu respuesta, prestando especial atención a los "
+    "aspectos arquitectónicos y de diseño."
+)
+
+MR_PRE_PROMPT = (
+    "Revisa los siguientes cambios de código git diff, enfocándote en estructura, seguridad, claridad, "
+    "arquitectura hexagonal, separación de responsabilidades y orientación a objetos."
+)
+
+MR_QUESTIONS = """Preguntas:
+1. Resume los cambios principales.
+2. ¿Es claro el código nuevo/modificado?
+3. ¿Son descriptivos los comentarios y nombres?
+4. ¿Se puede reducir la complejidad? ¿Ejemplos?
+5. ¿Algún bug? ¿Dónde?
+6. ¿Problemas de seguridad potenciales?
+7. ¿Los cambios respetan la arquitectura hexagonal (puertos y adaptadores)?
+8. ¿Hay una adecuada separación de incumbencias (responsabilidades)?
+9. ¿El código está bien orientado a objetos (encapsulación, herencia, polimorfismo)?
+10. ¿Sugerencias para alineación con mejores prácticas?"""
+
+MR_PROMPT_PREFIX = f"{MR_PRE_PROMPT}\n\n{MR_QUESTIONS}\n\n---DIFF---\n"
+
+MR_MERGE_PRE_PROMPT = (
+    "Las siguientes son reviews parciales de distintos grupos de archivos del mismo Merge Request. "
+    "Combínalas en una única review coherente, sin repetir información, respondiendo a las preguntas."
+)
+
+MR_MERGE_PROMPT_PREFIX = f"{MR_MERGE_PRE_PROMPT}\n\n{MR_QUESTIONS}\n\n---REVIEWS PARCIALES---\n"
+
+MANUAL_REVIEW_QUESTIONS = """Preguntas:
+1. Resume los cambios principales.
+2. Evalua los puntos de la rúbrica, si está disponible.
+3. ¿Es claro el código nuevo/modificado?
+4. ¿Son descriptivos los comentarios y nombres?
+5. ¿Se puede reducir la complejidad? ¿Ejemplos?
+6. ¿Algún bug? ¿Dónde?
+7. ¿Problemas de seguridad potenciales?
+8. ¿Los cambios respetan la arquitectura hexagonal (puertos y adaptadores)?
+9. ¿Hay una adecuada separación de incumbencias (responsabilidades)?
+10. ¿El código está bien orientado a objetos (encapsulación, herencia, polimorfismo)?
+11. ¿Sugerencias para alineación con mejores prácticas?"""
+
+PUSH_INSTRUCTIONS = (
+    "Eres un desarrollador senior especializado en arquitectura de software, revisando cambios de código "
+    "de un commit con enfoque en arquitectura hexagonal, separación de responsabilidades, orientación a "
+    "objetos y mejores prácticas de desarrollo. Responde en markdown para GitLab. Incluye versiones "
+    "concisas de las preguntas en la respuesta, prestando especial atención a los aspectos arquitectónicos "
+    "y de diseño."
+)
+
+PUSH_PRE_PROMPT = (
+    "Revisa el git diff de los commits de un push reciente, enfocándote en claridad, estructura, "
+    "seguridad, arquitectura hexagonal, separación de responsabilidades y orientación a objetos. "
+    "El diff puede abarcar varios commits: cada archivo se encabeza como \"=== [sha] ruta ===\", "
+    "donde sha identifica el commit que lo modificó, y un mismo archivo puede aparecer en varios commits."
+)
+
+PUSH_QUESTIONS = """Preguntas:
+1. Resume los cambios (estilo Changelog).
+2. ¿Claridad del código agregado/modificado?
+3. ¿Adecuación de comentarios y nombres?
+4. ¿Simplificación sin romper funcionalidad? ¿Ejemplos?
+5. ¿Algún bug? ¿Dónde?
+6. ¿Problemas de seguridad potenciales?
+7. ¿Los cambios respetan la arquitectura hexagonal (puertos y adaptadores)?
+8. ¿Hay una adecuada separación de incumbencias (responsabilidades)?
+9. ¿El código está bien orientado a objetos (encapsulación, herencia, polimorfismo)?"""
+
+PUSH_PROMPT_PREFIX = f"{PUSH_PRE_PROMPT}\n\n{PUSH_QUESTIONS}\n\n---DIFF---\n"
+
+INLINE_INSTRUCTIONS = "Devuelve SOLO JSON válido, sin texto adicional."
+
+INLINE_PROMPT = """
+Eres un revisor de código senior. A continuación verás diffs de GitLab
+con números de línea reales anotados entre corchetes, por ejemplo:
+
+=== FILE: src/app.py ===
+@@ -10,7 +10,9 @@
+[42] +def nueva_funcion():
+
+Genera comentarios SOLO en las partes donde realmente haya algo importante
+que revisar (bugs potenciales, problemas serios de diseño, seguridad, etc.).
+
+Responde ÚNICAMENTE con un JSON válido de la forma:
+{
+  "comments": [
+    {
+      "file_path": "ruta/archivo.py",
+      "new_line": 42,
+      "text": "Comentario conciso en español para esa línea."
+    }
+  ]
+}
+
+Reglas:
+- Usa exactamente las rutas de archivo que aparecen después de "=== FILE: ... ===".
+- Usa exactamente los números de línea que aparecen entre corchetes [].
+- No repitas el comentario general del MR.
+- Si no tienes nada importante que comentar inline, responde {"comments": []}.
+"""
+
+INLINE_PROMPT_PREFIX = f"{INLINE_PROMPT}\n\n"
+
+# Eventos ya encolados en la última hora, para no procesar dos veces los reintentos de GitLab
+MAX_SEEN_EVENTS = 10000
+SEEN_EVENTS_TTL = 60 * 60
+seen_events = TTLCache(maxsize=MAX_SEEN_EVENTS, ttl=SEEN_EVENTS_TTL)
+
+
+def get_event_key(payload):
+    """Construye la clave de idempotencia de un webhook: (tipo, proyecto, MR/acción o commit)."""
+    object_kind = payload.get("object_kind")
+    if object_kind == "merge_request":
+        attributes = payload.get("object_attributes") or {}
+        project_id = (payload.get("project") or {}).get("id")
+        return (object_kind, project_id, attributes.get("iid"), attributes.get("action"))
+    if object_kind == "push":
+        return (object_kind, payload.get("project_id"), payload.get("after"))
+    return None
+
+
+def register_event(key):
+    """Registra un evento y retorna False si ya había sido encolado dentro del TTL."""
+    if key in seen_events:
+        return False
+    seen_events[key] = True
+    return True
+
+
+# Caché persistente de respuestas de OpenAI, indexada por hash de modelo + instrucciones + input
+OPENAI_CACHE_DB = os.environ.get("OPENAI_CACHE_DB", "cache.db")
+OPENAI_CACHE_TTL = int(os.environ.get("OPENAI_CACHE_TTL", 24 * 60 * 60))
+
+cache_db = sqlite3.connect(OPENAI_CACHE_DB, check_same_thread=False)
+cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT, created_at INTEGER)")
+cache_db.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+cache_db.commit()
+
+
+def get_cache_key(model, instructions, input_text):
+    """Calcula la clave de caché de una solicitud a OpenAI."""
+    return hashlib.sha256(f"{model}|{instructions}|{input_text}".encode("utf-8")).hexdigest()
+
+
+def get_cached_answer(key):
+    """Retorna la respuesta cacheada si existe y no expiró, o None."""
+    row = cache_db.execute(
+        "SELECT answer FROM responses WHERE key = ? AND created_at > ?",
+        (key, int(time.time()) - OPENAI_CACHE_TTL),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def store_cached_answer(key, answer):
+    """Guarda (o reemplaza) la respuesta de OpenAI para la clave dada y elimina las entradas expiradas."""
+    now = int(time.time())
+    cache_db.execute("DELETE FROM responses WHERE created_at <= ?", (now - OPENAI_CACHE_TTL,))
+    cache_db.execute(
+        "INSERT OR REPLACE INTO responses (key, answer, created_at) VALUES (?, ?, ?)",
+        (key, answer, now),
+    )
+    cache_db.commit()
+
+
+# Caché semántica opcional: reutiliza reviews de diffs casi idénticos (requiere sentence-transformers).
+# Cada archivo se compara por separado y solo se reutiliza una review si el conjunto de rutas es el mismo.
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_MODEL = os.environ.get("SEMANTIC_CACHE_MODEL", "all-MiniLM-L6-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", 7 * 24 * 60 * 60))
+# all-MiniLM-L6-v2 solo lee ~256 word pieces (~1 KB de diff): los diffs se embeben por fragmentos
+SEMANTIC_CACHE_CHUNK_CHARS = 1000
+
+semantic_model = None
+if SEMANTIC_CACHE_ENABLED:
+    if SentenceTransformer is None:
+        logger.warning("SEMANTIC_CACHE_ENABLED está activo pero sentence-transformers no está instalado; caché semántica deshabilitada")
+    else:
+        logger.info(f"Cargando modelo de embeddings para caché semántica: {SEMANTIC_CACHE_MODEL}")
+        semantic_model = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+        cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_file_responses "
+            "(project_id TEXT, paths_key TEXT, embeddings BLOB, answer TEXT, created_at INTEGER)"
+        )
+        cache_db.execute(
+            "CREATE INDEX IF NOT EXISTS semantic_file_responses_lookup "
+            "ON semantic_file_responses (project_id, paths_key, created_at)"
+        )
+        cache_db.execute(
+            "CREATE INDEX IF NOT EXISTS semantic_file_responses_created_at "
+            "ON semantic_file_responses (created_at)"
+        )
+        cache_db.commit()
+
+
+def get_paths_key(paths):
+    """Calcula la clave del conjunto de rutas modificadas."""
+    return hashlib.sha256("\n".join(sorted(paths)).encode("utf-8")).hexdigest()
+
+
+async def embed_changes(changes):
+    """
+    Calcula un embedding normalizado por archivo (ordenados por ruta), promediando los embeddings
+    de fragmentos de SEMANTIC_CACHE_CHUNK_CHARS para cubrir todo el diff que ve el modelo.
+    Retorna (paths_key, matriz de embeddings) o None si la caché semántica está deshabilitada.
+    """
+    if semantic_model is None or not changes:
+        return None
+
+    files = sorted(
+        ((change.get("new_path") or change.get("old_path") or "", change["diff"][:MAX_DIFF_CHARS_PER_FILE])
+         for change in changes),
+        key=lambda item: item[0],
+    )
+
+    chunks, owners = [], []
+    for idx, (_, diff_text) in enumerate(files):
+        for start in range(0, len(diff_text), SEMANTIC_CACHE_CHUNK_CHARS):
+            chunks.append(diff_text[start:start + SEMANTIC_CACHE_CHUNK_CHARS])
+            owners.append(idx)
+
+    chunk_embeddings = await asyncio.to_thread(semantic_model.encode, chunks, normalize_embeddings=True)
+    chunk_embeddings = np.asarray(chunk_embeddings, dtype=np.float32)
+    owners = np.asarray(owners)
+
+    file_embeddings = np.stack([chunk_embeddings[owners == idx].mean(axis=0) for idx in range(len(files))])
+    file_embeddings /= np.linalg.norm(file_embeddings, axis=1, keepdims=True)
+    return get_paths_key(path for path, _ in files), file_embeddings.astype(np.float32)
+
+
+def get_semantic_cached_answer(project_id, paths_key, embeddings):
+    """
+    Retorna la review de un diff previo del proyecto con las mismas rutas modificadas si todos
+    sus archivos superan el umbral de similitud, o None.
+    """
+    rows = cache_db.execute(
+        "SELECT embeddings, answer FROM semantic_file_responses "
+        "WHERE project_id = ? AND paths_key = ? AND created_at > ?",
+        (str(project_id), paths_key, int(time.time()) - SEMANTIC_CACHE_TTL),
+    ).fetchall()
+
+    best_score, best_answer = 0.0, None
+    for blob, answer in rows:
+        cached = np.frombuffer(blob, dtype=np.float32)
+        if cached.size != embeddings.size:
+            continue
+        # La similitud del MR es la del archivo menos parecido
+        score = float(np.min(np.sum(cached.reshape(embeddings.shape) * embeddings, axis=1)))
+        if score > best_score:
+            best_score, best_answer = score, answer
+
+    if best_score > SEMANTIC_CACHE_THRESHOLD:
+        logger.info(f"Coincidencia en caché semántica (similitud mínima por archivo: {best_score:.3f})")
+        return best_answer
+    return None
+
+
+def store_semantic_cached_answer(project_id, paths_key, embeddings, answer):
+    """Guarda los embeddings por archivo junto a la respuesta de OpenAI y elimina las entradas expiradas."""
+    now = int(time.time())
+    cache_db.execute("DELETE FROM semantic_file_responses WHERE created_at <= ?", (now - SEMANTIC_CACHE_TTL,))
+    cache_db.execute(
+        "INSERT INTO semantic_file_responses (project_id, paths_key, embeddings, answer, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (str(project_id), paths_key, embeddings.tobytes(), answer, now),
+    )
+    cache_db.commit()
+
+
+async def run_in_background(handler, payload):
+    """Ejecuta el handler como tarea de background, registrando el resultado o cualquier excepción."""
+    try:
+        body, status_code = await handler(payload)
+        logger.info(f"Webhook procesado en background ({handler.__name__}): {status_code} - {body}")
+    except Exception as e:
+        logger.error(f"Error inesperado en tarea de background ({handler.__name__}): {e}")
+
+
 # Validar configuración al inicio
 try:
     validate_environment()
@@ -66,27 +532,36 @@ except ValueError as e:
     logger.error(f"Error de configuración: {e}")
     exit(1)
 
+@app.after_serving
+async def close_http_clients():
+    """Cierra los pools de conexiones compartidos al apagar el servidor."""
+    await gitlab_client.aclose()
+    await openai_client.close()
+
 @app.route('/webhook', methods=['POST'])
-def webhook():
+async def webhook():
     logger.info("=== NUEVO WEBHOOK RECIBIDO ===")
-    logger.info(f"Headers recibidos: {dict(request.headers)}")
-    logger.info(f"Content-Type: {request.content_type}")
-    logger.info(f"Content-Length: {request.content_length}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Headers recibidos: %s", list(request.headers.items()))
+    logger.info("Content-Type: %s", request.content_type)
+    logger.info("Content-Length: %s", request.content_length)
     
     # Validar token de GitLab
     received_token = request.headers.get("X-Gitlab-Token")
     expected_token = os.environ.get("EXPECTED_GITLAB_TOKEN")
     
-    logger.info(f"Token recibido: {received_token[:10]}..." if received_token else "No token recibido")
-    logger.info(f"Token esperado: {expected_token[:10]}..." if expected_token else "No token esperado configurado")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Token recibido: {received_token[:10]}..." if received_token else "No token recibido")
+        logger.debug(f"Token esperado: {expected_token[:10]}..." if expected_token else "No token esperado configurado")
     
-    if received_token != expected_token:
+    if not tokens_match(received_token, expected_token):
         logger.warning("Token de GitLab no válido - acceso denegado")
         return "No autorizado", 403
     
     try:
-        payload = request.json
-        logger.info(f"Payload recibido: {json.dumps(payload, indent=2)}")
+        payload = await request.get_json()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Payload recibido: %s", payload)
     except Exception as e:
         logger.error(f"Error al parsear JSON del payload: {e}")
         return "Error en el payload JSON", 400
@@ -99,16 +574,23 @@ def webhook():
     logger.info(f"Tipo de evento: {object_kind}")
     
     if object_kind == "merge_request":
-        logger.info("Procesando evento de Merge Request")
-        return process_merge_request(payload)
+        handler = process_merge_request
     elif object_kind == "push":
-        logger.info("Procesando evento de Push")
-        return process_push_event(payload)
+        handler = process_push_event
     else:
         logger.warning(f"Tipo de evento no soportado: {object_kind}")
         return f"Tipo de evento no soportado: {object_kind}", 200
 
-def process_merge_request(payload):
+    event_key = get_event_key(payload)
+    if not register_event(event_key):
+        logger.info(f"Evento duplicado ignorado: {event_key}")
+        return "Evento duplicado", 200
+
+    logger.info(f"Encolando evento {object_kind} para procesamiento en background")
+    app.add_background_task(run_in_background, handler, payload)
+    return "Accepted", 202
+
+async def process_merge_request(payload):
     """Procesa eventos de Merge Request"""
     try:
         action = payload["object_attributes"]["action"]
@@ -127,10 +609,9 @@ def process_merge_request(payload):
         changes_url = f"{gitlab_url}/projects/{project_id}/merge_requests/{mr_id}/changes"
         logger.info(f"URL de cambios: {changes_url}")
 
-        headers = {"Private-Token": gitlab_token}
         logger.info("Obteniendo cambios del MR desde GitLab...")
         
-        response = requests.get(changes_url, headers=headers)
+        response = await gitlab_client.get(changes_url)
         logger.info(f"Respuesta de GitLab - Status: {response.status_code}")
         
         if response.status_code != 200:
@@ -140,59 +621,80 @@ def process_merge_request(payload):
         mr_changes = response.json()
         logger.info(f"Cambios obtenidos: {len(mr_changes.get('changes', []))} archivos modificados")
         
-        diffs = [change["diff"] for change in mr_changes["changes"]]
-        logger.info(f"Total de diffs: {len(diffs)}")
+        reviewable_changes = filter_reviewable_changes(mr_changes["changes"])
+        if not reviewable_changes:
+            logger.info("El MR solo contiene archivos generados o cambios de espacios en blanco; se omite la review")
+            return "Sin cambios relevantes para revisar", 200
+
+        diff_parts = build_bounded_diff_parts(reviewable_changes)
+        diff_text = "\n".join(diff_parts)
+        logger.info(f"Longitud del diff acotado: {len(diff_text)} caracteres")
         
-        # Prompt en español
-        pre_prompt = "Revisa los siguientes cambios de código git diff, enfocándote en estructura, seguridad, claridad, arquitectura hexagonal, separación de responsabilidades y orientación a objetos."
-
-        questions = """
-        Preguntas:
-        1. Resume los cambios principales.
-        2. ¿Es claro el código nuevo/modificado?
-        3. ¿Son descriptivos los comentarios y nombres?
-        4. ¿Se puede reducir la complejidad? ¿Ejemplos?
-        5. ¿Algún bug? ¿Dónde?
-        6. ¿Problemas de seguridad potenciales?
-        7. ¿Los cambios respetan la arquitectura hexagonal (puertos y adaptadores)?
-        8. ¿Hay una adecuada separación de incumbencias (responsabilidades)?
-        9. ¿El código está bien orientado a objetos (encapsulación, herencia, polimorfismo)?
-        10. ¿Sugerencias para alineación con mejores prácticas?
-        """
-
         # Preparar el input para la API de Responses
-        input_text = f"{pre_prompt}\n\n{''.join(diffs)}{questions}"
-        
-        logger.info("Enviando solicitud a OpenAI usando Responses API...")
-        logger.info(f"Modelo a usar: {os.environ.get('OPENAI_API_MODEL', 'gpt-3.5-turbo')}")
-        
-        try:            
-            # Usar la API de Responses
-            response = openai_client.responses.create(
-                model=os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo",
-                input=input_text,
-                instructions="Eres un desarrollador senior especializado en arquitectura de software, revisando cambios de código con enfoque en arquitectura hexagonal, separación de responsabilidades, orientación a objetos y mejores prácticas de desarrollo. Responde en markdown compatible con GitLab. Incluye una versión concisa de cada pregunta en tu respuesta, prestando especial atención a los aspectos arquitectónicos y de diseño."
-            )
-            logger.info("Respuesta de OpenAI recibida exitosamente")
-            answer = response.output_text.strip()
-            answer += "\n\nEste comentario fue generado por inteligencia artificial."
-        except Exception as e:
-            logger.error(f"Error al llamar a OpenAI: {e}")
-            answer = "Lo siento, no me siento bien hoy. Por favor, pide a un humano que revise este PR."
+        input_text = MR_PROMPT_PREFIX + diff_text
+        model = os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo"
+        instructions = MR_INSTRUCTIONS
+
+        # Permite desactivar la caché desde la descripción del MR
+        description = payload["object_attributes"].get("description") or ""
+        use_cache = "do not cache" not in description.lower()
+        cache_key = get_cache_key(model, instructions, input_text)
+        cached_answer = None
+        if use_cache:
+            try:
+                cached_answer = get_cached_answer(cache_key)
+            except sqlite3.Error as e:
+                logger.error(f"No se pudo consultar la caché de respuestas: {e}")
+
+        semantic_entry = None
+        if use_cache and cached_answer is None:
+            semantic_entry = await embed_changes(reviewable_changes)
+            if semantic_entry is not None:
+                try:
+                    cached_answer = get_semantic_cached_answer(project_id, *semantic_entry)
+                except sqlite3.Error as e:
+                    logger.error(f"No se pudo consultar la caché semántica: {e}")
+
+        if cached_answer is not None:
+            logger.info("Respuesta encontrada en caché, se omite la llamada a OpenAI")
+            answer = cached_answer
             answer += "\n\nEste comentario fue generado por inteligencia artificial."
-            answer += f"\n\nError: {str(e)}"
-        try:
-            logger.info(f"Metricas: {response.usage}")
-        except Exception as e:
-            logger.error(f"Error al obtener metricas: {e}")
+        else:
+            logger.info("Enviando solicitud a OpenAI usando Responses API...")
+            logger.info(f"Modelo a usar: {model}")
+
+            usage = None
+            generated_text = None
+            try:
+                # Usar la API de Responses en modo streaming
+                output_text, usage = await generate_sharded_mr_review(model, instructions, input_text, diff_parts)
+                logger.info("Respuesta de OpenAI recibida exitosamente")
+                generated_text = output_text.strip()
+                answer = generated_text
+                answer += "\n\nEste comentario fue generado por inteligencia artificial."
+            except Exception as e:
+                logger.error(f"Error al llamar a OpenAI: {e}")
+                answer = "Lo siento, no me siento bien hoy. Por favor, pide a un humano que revise este PR."
+                answer += "\n\nEste comentario fue generado por inteligencia artificial."
+                answer += f"\n\nError: {str(e)}"
+            logger.info(f"Metricas: {usage}")
+
+            # Un fallo de la caché (p. ej. "database is locked") no debe descartar una respuesta válida
+            if use_cache and generated_text is not None:
+                try:
+                    store_cached_answer(cache_key, generated_text)
+                    if semantic_entry is not None:
+                        store_semantic_cached_answer(project_id, *semantic_entry, generated_text)
+                except sqlite3.Error as e:
+                    logger.error(f"No se pudo guardar la respuesta en caché: {e}")
         logger.info(f"Respuesta generada (longitud: {len(answer)} caracteres)")
-        logger.info(f"Respuesta: {answer[:200]}...")
+        logger.debug("Respuesta: %s...", answer[:200])
         
         comment_url = f"{gitlab_url}/projects/{project_id}/merge_requests/{mr_id}/notes"
         comment_payload = {"body": answer}
         
         logger.info(f"Enviando comentario a: {comment_url}")
-        comment_response = requests.post(comment_url, headers=headers, json=comment_payload)
+        comment_response = await gitlab_client.post(comment_url, json=comment_payload)
         
         logger.info(f"Respuesta del comentario - Status: {comment_response.status_code}")
         if comment_response.status_code != 201:
@@ -260,7 +762,7 @@ def extract_project_path_and_iid_from_url(mr_url):
         return None, None
 
 
-def build_ai_review_for_mr(project_id, mr_iid, extra_context=None, private_token=None):
+async def build_ai_review_for_mr(project_id, mr_iid, extra_context=None, private_token=None):
     """Genera el texto de la review de MR usando OpenAI.
 
     Si se proporciona `extra_context`, este se añadirá al prompt para que el modelo
@@ -269,10 +771,9 @@ def build_ai_review_for_mr(project_id, mr_iid, extra_context=None, private_token
     changes_url = f"{gitlab_url}/projects/{project_id}/merge_requests/{mr_iid}/changes"
     logger.info(f"URL de cambios para review manual: {changes_url}")
 
-    headers = {"Private-Token": private_token or gitlab_token}
     logger.info("Obteniendo cambios del MR desde GitLab (review manual)...")
 
-    response = requests.get(changes_url, headers=headers)
+    response = await gitlab_client.get(changes_url, headers=gitlab_headers(private_token))
     logger.info(f"Respuesta de GitLab - Status: {response.status_code}")
 
     if response.status_code != 200:
@@ -282,14 +783,6 @@ def build_ai_review_for_mr(project_id, mr_iid, extra_context=None, private_token
     mr_changes = response.json()
     logger.info(f"Cambios obtenidos: {len(mr_changes.get('changes', []))} archivos modificados")
 
-    diffs = [change["diff"] for change in mr_changes.get("changes", [])]
-    logger.info(f"Total de diffs: {len(diffs)}")
-
-    base_prompt = (
-        "Revisa los siguientes cambios de código git diff, enfocándote en estructura, seguridad, claridad, "
-        "arquitectura hexagonal, separación de responsabilidades y orientación a objetos."
-    )
-
     if extra_context:
         pre_prompt = (
             "Estás corrigiendo un ejercicio siguiendo la siguiente rúbrica, contexto y criterios de evaluación.\n"
@@ -298,45 +791,32 @@ def build_ai_review_for_mr(project_id, mr_iid, extra_context=None, private_token
             "CONTEXTO DEL EJERCICIO / RÚBRICA:\n"
             f"{extra_context}\n\n"
             "Además de ese contexto, también debes tener en cuenta lo siguiente sobre los cambios de código:\n"
-            f"{base_prompt}"
+            f"{MR_PRE_PROMPT}"
         )
     else:
-        pre_prompt = base_prompt
-
-    questions = """
-    Preguntas:
-    1. Resume los cambios principales.
-    2. Evalua los puntos de la rúbrica, si está disponible.
-    3. ¿Es claro el código nuevo/modificado?
-    4. ¿Son descriptivos los comentarios y nombres?
-    5. ¿Se puede reducir la complejidad? ¿Ejemplos?
-    6. ¿Algún bug? ¿Dónde?
-    7. ¿Problemas de seguridad potenciales?
-    8. ¿Los cambios respetan la arquitectura hexagonal (puertos y adaptadores)?
-    9. ¿Hay una adecuada separación de incumbencias (responsabilidades)?
-    10. ¿El código está bien orientado a objetos (encapsulación, herencia, polimorfismo)?
-    11. ¿Sugerencias para alineación con mejores prácticas?
-    """
+        pre_prompt = MR_PRE_PROMPT
 
-    input_text = f"{pre_prompt}\n\n{''.join(diffs)}{questions}"
+    # Texto fijo primero y el diff al final, para aprovechar el cacheo de prefijos del proveedor
+    prompt_prefix = f"{pre_prompt}\n\n{MANUAL_REVIEW_QUESTIONS}\n\n---DIFF---\n"
+    model = os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo"
+    diff_text = build_bounded_diff(
+        mr_changes.get("changes", []), model, MAX_INPUT_TOKENS - count_tokens(model, prompt_prefix)
+    )
+    logger.info(f"Longitud del diff acotado: {len(diff_text)} caracteres")
+    input_text = prompt_prefix + diff_text
 
     logger.info("Enviando solicitud a OpenAI usando Responses API (review manual)...")
-    logger.info(f"Modelo a usar: {os.environ.get('OPENAI_API_MODEL', 'gpt-3.5-turbo')}")
+    logger.info(f"Modelo a usar: {model}")
 
+    usage = None
     try:
-        response = openai_client.responses.create(
-            model=os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo",
-            input=input_text,
-            instructions=(
-                "Eres un desarrollador senior especializado en arquitectura de software, revisando cambios de "
-                "código con enfoque en arquitectura hexagonal, separación de responsabilidades, orientación a "
-                "objetos y mejores prácticas de desarrollo. Responde en markdown compatible con GitLab. "
-                "Incluye una versión concisa de cada pregunta en tu respuesta, prestando especial atención a los "
-                "aspectos arquitectónicos y de diseño."
-            ),
+        output_text, usage = await stream_openai_response(
+            model,
+            MR_INSTRUCTIONS,
+            input_text,
         )
         logger.info("Respuesta de OpenAI recibida exitosamente (review manual)")
-        answer = response.output_text.strip()
+        answer = output_text.strip()
         answer += "\n\nEste comentario fue generado por inteligencia artificial."
     except Exception as e:
         logger.error(f"Error al llamar a OpenAI (review manual): {e}")
@@ -346,25 +826,21 @@ def build_ai_review_for_mr(project_id, mr_iid, extra_context=None, private_token
             f"Error: {str(e)}"
         )
 
-    try:
-        logger.info(f"Métricas de OpenAI (review manual): {response.usage}")
-    except Exception as e:
-        logger.error(f"Error al obtener métricas (review manual): {e}")
+    logger.info(f"Métricas de OpenAI (review manual): {usage}")
 
     logger.info(f"Respuesta generada (review manual, longitud: {len(answer)} caracteres)")
-    logger.info(f"Respuesta (primeros 200 chars): {answer[:200]}...")
+    logger.debug("Respuesta (primeros 200 chars): %s...", answer[:200])
 
     return answer
 
 
-def create_pending_review_draft_note(project_id, mr_iid, body, private_token=None):
+async def create_pending_review_draft_note(project_id, mr_iid, body, private_token=None):
     """Crea un draft note en el MR, dejando la review en estado pendiente."""
     draft_url = f"{gitlab_url}/projects/{project_id}/merge_requests/{mr_iid}/draft_notes"
-    headers = {"Private-Token": private_token or gitlab_token}
     payload = {"note": body}
 
     logger.info(f"Creando draft note (review pendiente) en: {draft_url}")
-    response = requests.post(draft_url, headers=headers, json=payload)
+    response = await gitlab_client.post(draft_url, headers=gitlab_headers(private_token), json=payload)
     logger.info(f"Respuesta de GitLab al crear draft note - Status: {response.status_code}")
 
     if response.status_code != 201:
@@ -374,6 +850,165 @@ def create_pending_review_draft_note(project_id, mr_iid, body, private_token=Non
     logger.info("Draft note creado exitosamente; la review queda en estado pendiente.")
 
 
+# Archivos generados o de dependencias que no aportan a la review
+# Los lockfiles *.lock (yarn, poetry, Pipfile, composer, Gemfile, Cargo) se cubren por sufijo
+GENERATED_FILE_NAMES = {"package-lock.json", "pnpm-lock.yaml", "go.sum"}
+GENERATED_FILE_SUFFIXES = (".lock", ".min.js", ".min.css", ".map")
+GENERATED_DIR_PREFIXES = ("generated/", "dist/")
+
+
+def is_generated_file(path):
+    """Indica si la ruta corresponde a un lockfile, archivo minificado o generado."""
+    if not path:
+        return False
+    file_name = path.rsplit("/", 1)[-1]
+    return (
+        file_name in GENERATED_FILE_NAMES
+        or path.endswith(GENERATED_FILE_SUFFIXES)
+        or path.startswith(GENERATED_DIR_PREFIXES)
+        or any(f"/{prefix}" in path for prefix in GENERATED_DIR_PREFIXES)
+    )
+
+
+def has_code_change(diff_text):
+    """Indica si el diff tiene al menos una línea agregada o borrada con contenido (no solo espacios)."""
+    in_hunk = False
+    for line in diff_text.splitlines():
+        if line.startswith("@@"):
+            in_hunk = True
+            continue
+        # GitLab no incluye cabeceras ---/+++; si aparecen, solo se ignoran antes del primer hunk
+        if not in_hunk and line.startswith(("+++", "---")):
+            continue
+        if line.startswith(("+", "-")) and line[1:].strip():
+            return True
+    return False
+
+
+def filter_reviewable_changes(changes):
+    """Descarta los cambios sin valor para la review: archivos generados y diffs solo de espacios."""
+    reviewable = [
+        change for change in changes
+        if change.get("diff")
+        and not is_generated_file(change.get("new_path") or change.get("old_path"))
+        and has_code_change(change["diff"])
+    ]
+    if len(reviewable) != len(changes):
+        logger.info(f"Se omiten {len(changes) - len(reviewable)} archivos generados o sin cambios de código")
+    return reviewable
+
+
+def build_bounded_diff_parts(changes, model=None, max_tokens=None):
+    """
+    Retorna el diff de cada archivo (con su cabecera) respetando un límite por archivo y un límite total.
+    Los archivos se recorren de menor a mayor diff para incluir la mayor cantidad posible;
+    lo que excede los límites se trunca al final de una línea con una marca y el resto de archivos
+    se omite. Si se indica max_tokens, el total también se acota en tokens del modelo.
+    """
+    parts = []
+    budget = MAX_DIFF_CHARS
+    token_budget = max_tokens
+    changes_with_diff = sorted((c for c in changes if c.get("diff")), key=lambda c: len(c["diff"]))
+
+    for included, change in enumerate(changes_with_diff):
+        path = change.get("new_path") or change.get("old_path")
+        header = f"=== {path} ===\n"
+        diff_text = change["diff"]
+        snippet = diff_text[:min(MAX_DIFF_CHARS_PER_FILE, budget)]
+        if token_budget is not None:
+            # Cabecera, marca de truncado y el salto de línea que une las partes
+            available = token_budget - count_tokens(model, header + DIFF_TRUNCATION_MARKER) - 1
+            snippet = truncate_to_tokens(model, snippet, available, marker="") if available > 0 else ""
+
+        if budget <= 0 or not snippet:
+            logger.warning(
+                f"Límite total de diff alcanzado; se omiten {len(changes_with_diff) - included} archivos"
+            )
+            break
+
+        if len(snippet) < len(diff_text):
+            # Cortar en el último salto de línea para no dejar líneas a medias
+            last_newline = snippet.rfind("\n")
+            if last_newline > 0:
+                snippet = snippet[:last_newline + 1]
+            snippet += DIFF_TRUNCATION_MARKER
+
+        part = header + snippet
+        parts.append(part)
+        budget -= len(snippet)
+        if token_budget is not None:
+            token_budget -= count_tokens(model, part) + 1
+
+    return parts
+
+
+def build_bounded_diff(changes, model=None, max_tokens=None):
+    """Concatena los diffs acotados de los cambios (ver build_bounded_diff_parts)."""
+    return "\n".join(build_bounded_diff_parts(changes, model, max_tokens))
+
+
+# Tamaño máximo de cada grupo de archivos que se revisa en una llamada independiente
+MAX_SHARD_TOKENS = int(os.environ.get("MAX_SHARD_TOKENS", 8_000))
+
+
+def pack_diff_shards(model, diff_parts):
+    """Agrupa los diffs por archivo, en orden, en shards de hasta MAX_SHARD_TOKENS tokens."""
+    shards = []
+    current, current_tokens = [], 0
+    for part in diff_parts:
+        part_tokens = count_tokens(model, part)
+        if current and current_tokens + part_tokens > MAX_SHARD_TOKENS:
+            shards.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(part)
+        current_tokens += part_tokens
+    if current:
+        shards.append("\n".join(current))
+    return shards
+
+
+async def generate_sharded_mr_review(model, instructions, input_text, diff_parts):
+    """
+    Genera la review del MR. Si el diff no entra en un solo shard, revisa cada grupo de archivos
+    en paralelo y combina las reviews parciales con una llamada final. Si entra, envía input_text
+    (el prompt completo ya armado por el llamador). Retorna (texto, [usage]).
+    """
+    shards = pack_diff_shards(model, diff_parts)
+    if len(shards) <= 1:
+        output_text, usage = await stream_openai_response(model, instructions, input_text)
+        return output_text, [usage]
+
+    logger.info(f"Diff dividido en {len(shards)} shards; se revisan en paralelo")
+    tasks = [
+        asyncio.ensure_future(stream_openai_response(model, instructions, MR_PROMPT_PREFIX + shard))
+        for shard in shards
+    ]
+    try:
+        partial_reviews = await asyncio.gather(*tasks)
+    except BaseException:
+        # Si un shard falla, la review completa falla: no seguir gastando en los demás
+        for task in tasks:
+            task.cancel()
+        # Esperar a que las tareas canceladas terminen y cierren sus streams antes de propagar
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    # Repartir el presupuesto de tokens entre las reviews parciales para que ninguna quede
+    # cortada al ajustar el input de la llamada final a MAX_INPUT_TOKENS
+    headers = [f"=== Review parcial {idx} ===\n" for idx in range(1, len(partial_reviews) + 1)]
+    overhead = count_tokens(model, MR_MERGE_PROMPT_PREFIX + "\n\n".join(headers))
+    # Marcador de truncado más un token de margen por el redondeo al recodificar cada review
+    overhead += (count_tokens(model, TOKEN_TRUNCATION_MARKER) + 1) * len(headers)
+    budget = max((MAX_INPUT_TOKENS - overhead) // len(partial_reviews), 1)
+    merge_input = MR_MERGE_PROMPT_PREFIX + "\n\n".join(
+        header + truncate_to_tokens(model, text.strip(), budget)
+        for header, (text, _) in zip(headers, partial_reviews)
+    )
+    logger.info("Combinando reviews parciales...")
+    output_text, usage = await stream_openai_response(model, instructions, merge_input)
+    return output_text, [partial_usage for _, partial_usage in partial_reviews] + [usage]
+
+
 def build_annotated_diffs_for_ai(mr_changes):
     """
     Construye un string con diffs anotados con números de línea reales (lado nuevo)
@@ -439,7 +1074,7 @@ def build_annotated_diffs_for_ai(mr_changes):
     return "\n".join(annotated_parts)
 
 
-def generate_inline_draft_notes_for_mr(project_id, mr_iid, private_token=None):
+async def generate_inline_draft_notes_for_mr(project_id, mr_iid, private_token=None):
     """
     Usa OpenAI para sugerir comentarios inline y los crea como draft notes
     en el MR correspondiente (quedan en pending).
@@ -447,10 +1082,10 @@ def generate_inline_draft_notes_for_mr(project_id, mr_iid, private_token=None):
     try:
         # 1) Obtener información del MR (incluye diff_refs)
         mr_url = f"{gitlab_url}/projects/{project_id}/merge_requests/{mr_iid}"
-        headers = {"Private-Token": private_token or gitlab_token}
+        headers = gitlab_headers(private_token)
 
         logger.info(f"Obteniendo información del MR para inline comments: {mr_url}")
-        mr_resp = requests.get(mr_url, headers=headers)
+        mr_resp = await gitlab_client.get(mr_url, headers=headers)
         logger.info(f"Respuesta MR info - Status: {mr_resp.status_code}")
 
         if mr_resp.status_code != 200:
@@ -470,7 +1105,7 @@ def generate_inline_draft_notes_for_mr(project_id, mr_iid, private_token=None):
         # 2) Obtener cambios del MR
         changes_url = f"{gitlab_url}/projects/{project_id}/merge_requests/{mr_iid}/changes"
         logger.info(f"Obteniendo cambios del MR para inline comments: {changes_url}")
-        changes_resp = requests.get(changes_url, headers=headers)
+        changes_resp = await gitlab_client.get(changes_url, headers=headers)
         logger.info(f"Respuesta MR changes (inline) - Status: {changes_resp.status_code}")
 
         if changes_resp.status_code != 200:
@@ -485,42 +1120,14 @@ def generate_inline_draft_notes_for_mr(project_id, mr_iid, private_token=None):
             return
 
         # 3) Llamar a OpenAI para obtener sugerencias de comentarios inline
-        inline_prompt = """
-Eres un revisor de código senior. A continuación verás diffs de GitLab
-con números de línea reales anotados entre corchetes, por ejemplo:
-
-=== FILE: src/app.py ===
-@@ -10,7 +10,9 @@
-[42] +def nueva_funcion():
-
-Genera comentarios SOLO en las partes donde realmente haya algo importante
-que revisar (bugs potenciales, problemas serios de diseño, seguridad, etc.).
-
-Responde ÚNICAMENTE con un JSON válido de la forma:
-{
-  "comments": [
-    {
-      "file_path": "ruta/archivo.py",
-      "new_line": 42,
-      "text": "Comentario conciso en español para esa línea."
-    }
-  ]
-}
-
-Reglas:
-- Usa exactamente las rutas de archivo que aparecen después de "=== FILE: ... ===".
-- Usa exactamente los números de línea que aparecen entre corchetes [].
-- No repitas el comentario general del MR.
-- Si no tienes nada importante que comentar inline, responde {"comments": []}.
-"""
-
-        input_text = f"{inline_prompt}\n\n{annotated_diffs}"
+        model = os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo"
+        input_text = fit_input_to_token_limit(model, INLINE_PROMPT_PREFIX + annotated_diffs)
 
         logger.info("Enviando solicitud a OpenAI para generar comentarios inline...")
-        response = openai_client.responses.create(
-            model=os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo",
+        response = await openai_client.responses.create(
+            model=model,
             input=input_text,
-            instructions="Devuelve SOLO JSON válido, sin texto adicional.",
+            instructions=INLINE_INSTRUCTIONS,
         )
         raw_output = response.output_text.strip()
         logger.info(f"Respuesta de OpenAI (inline) recibida, longitud: {len(raw_output)}")
@@ -565,7 +1172,7 @@ Reglas:
                 }
 
                 logger.info(f"Creando draft note inline para {file_path}:{new_line}")
-                draft_resp = requests.post(draft_url, headers=headers, json=payload)
+                draft_resp = await gitlab_client.post(draft_url, headers=headers, json=payload)
                 logger.info(f"Respuesta draft note inline - Status: {draft_resp.status_code}")
 
                 if draft_resp.status_code != 201:
@@ -575,73 +1182,70 @@ Reglas:
 
     except Exception as e:
         logger.error(f"Error inesperado generando comentarios inline para MR {mr_iid}: {e}")
-def process_push_event(payload):
+async def process_push_event(payload):
     """Procesa eventos de Push"""
     try:
         project_id = payload["project_id"]
         commit_id = payload["after"]
         project_name = payload.get("project", {}).get("name", "Proyecto desconocido")
-        
-        logger.info(f"Procesando push del proyecto {project_name} (ID: {project_id})")
-        logger.info(f"Commit ID: {commit_id}")
-        
-        commit_url = f"{gitlab_url}/projects/{project_id}/repository/commits/{commit_id}/diff"
-        logger.info(f"URL de diff del commit: {commit_url}")
 
-        headers = {"Private-Token": gitlab_token}
-        logger.info("Obteniendo diff del commit desde GitLab...")
-        
-        response = requests.get(commit_url, headers=headers)
-        logger.info(f"Respuesta de GitLab - Status: {response.status_code}")
-        
-        if response.status_code != 200:
-            logger.error(f"Error al obtener diff del commit: {response.status_code} - {response.text}")
-            return f"Error al obtener diff del commit: {response.status_code}", 500
-        
-        changes = response.json()
-        logger.info(f"Cambios obtenidos: {len(changes)} archivos modificados")
+        # Revisar todos los commits del push (el comentario se publica en el último)
+        commit_ids = [commit["id"] for commit in payload.get("commits") or [] if commit.get("id")] or [commit_id]
 
-        changes_string = ''.join([str(change) for change in changes])
+        logger.info(f"Procesando push del proyecto {project_name} (ID: {project_id})")
+        logger.info(f"Commit ID: {commit_id} ({len(commit_ids)} commits en el push)")
+
+        # Los diffs de cada commit son independientes: se piden en paralelo
+        logger.info("Obteniendo diffs de los commits desde GitLab...")
+        responses = await asyncio.gather(*(
+            gitlab_client.get(f"{gitlab_url}/projects/{project_id}/repository/commits/{sha}/diff")
+            for sha in commit_ids
+        ))
+
+        total_changes = 0
+        reviewable_changes = []
+        for sha, response in zip(commit_ids, responses):
+            logger.info(f"Respuesta de GitLab para commit {sha} - Status: {response.status_code}")
+            if response.status_code != 200:
+                logger.error(f"Error al obtener diff del commit {sha}: {response.status_code} - {response.text}")
+                return f"Error al obtener diff del commit: {response.status_code}", 500
+            commit_changes = response.json()
+            total_changes += len(commit_changes)
+            # Etiquetar cada archivo con su commit para que el modelo no mezcle diffs de commits distintos
+            for change in filter_reviewable_changes(commit_changes):
+                path = change.get("new_path") or change.get("old_path") or ""
+                reviewable_changes.append({**change, "new_path": f"[{sha[:8]}] {path}"})
+
+        logger.info(f"Cambios obtenidos: {total_changes} archivos modificados")
+
+        if not reviewable_changes:
+            logger.info("El push solo contiene archivos generados o cambios de espacios en blanco; se omite la review")
+            return "Sin cambios relevantes para revisar", 200
+
+        model = os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo"
+        changes_string = build_bounded_diff(
+            reviewable_changes, model, MAX_INPUT_TOKENS - count_tokens(model, PUSH_PROMPT_PREFIX)
+        )
         logger.info(f"Longitud del diff: {len(changes_string)} caracteres")
 
-        # Prompt en español
-        pre_prompt = "Revisa el git diff de un commit reciente, enfocándote en claridad, estructura, seguridad, arquitectura hexagonal, separación de responsabilidades y orientación a objetos."
-
-        questions = """
-        Preguntas:
-        1. Resume los cambios (estilo Changelog).
-        2. ¿Claridad del código agregado/modificado?
-        3. ¿Adecuación de comentarios y nombres?
-        4. ¿Simplificación sin romper funcionalidad? ¿Ejemplos?
-        5. ¿Algún bug? ¿Dónde?
-        6. ¿Problemas de seguridad potenciales?
-        7. ¿Los cambios respetan la arquitectura hexagonal (puertos y adaptadores)?
-        8. ¿Hay una adecuada separación de incumbencias (responsabilidades)?
-        9. ¿El código está bien orientado a objetos (encapsulación, herencia, polimorfismo)?
-        """
-
         # Preparar el input para la API de Responses
-        input_text = f"{pre_prompt}\n\n{changes_string}{questions}"
+        input_text = PUSH_PROMPT_PREFIX + changes_string
         
         logger.info("Enviando solicitud a OpenAI para revisión de commit usando Responses API...")
-        logger.info(f"Modelo a usar: {os.environ.get('OPENAI_API_MODEL', 'gpt-3.5-turbo')}")
+        logger.info(f"Modelo a usar: {model}")
         
         try:
-            # Inicializar cliente si no está inicializado
-            global openai_client
-            if openai_client is None:
-                openai_client = get_openai_client()
-            
-            # Usar la API de Responses
-            response = openai_client.responses.create(
-                model=os.environ.get("OPENAI_API_MODEL") or "gpt-3.5-turbo",
-                input=input_text,
-                instructions="Eres un desarrollador senior especializado en arquitectura de software, revisando cambios de código de un commit con enfoque en arquitectura hexagonal, separación de responsabilidades, orientación a objetos y mejores prácticas de desarrollo. Responde en markdown para GitLab. Incluye versiones concisas de las preguntas en la respuesta, prestando especial atención a los aspectos arquitectónicos y de diseño."
+            # Usar la API de Responses en modo streaming
+            output_text, usage = await stream_openai_response(
+                model,
+                PUSH_INSTRUCTIONS,
+                input_text,
             )
             logger.info("Respuesta de OpenAI recibida exitosamente")
-            answer = response.output[0].content[0].text.strip()
+            logger.info(f"Metricas: {usage}")
+            answer = output_text.strip()
             answer += "\n\nPara referencia, me dieron las siguientes preguntas: \n"
-            for question in questions.split("\n"):
+            for question in PUSH_QUESTIONS.split("\n"):
                 answer += f"\n{question}"
             answer += "\n\nEste comentario fue generado por un pato de inteligencia artificial."
         except Exception as e:
@@ -651,13 +1255,13 @@ def process_push_event(payload):
             answer += f"\n\nError: {str(e)}"
 
         logger.info(f"Respuesta generada (longitud: {len(answer)} caracteres)")
-        logger.info(f"Respuesta: {answer[:200]}...")
+        logger.debug("Respuesta: %s...", answer[:200])
         
         comment_url = f"{gitlab_url}/projects/{project_id}/repository/commits/{commit_id}/comments"
         comment_payload = {"note": answer}
         
         logger.info(f"Enviando comentario a: {comment_url}")
-        comment_response = requests.post(comment_url, headers=headers, json=comment_payload)
+        comment_response = await gitlab_client.post(comment_url, json=comment_payload)
         
         logger.info(f"Respuesta del comentario - Status: {comment_response.status_code}")
         if comment_response.status_code != 201:
@@ -674,11 +1278,8 @@ def process_push_event(payload):
         logger.error(f"Error inesperado procesando push: {e}")
         return f"Error procesando push: {e}", 500
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Endpoint de health check para verificar el estado de la aplicación"""
-    logger.info("Health check solicitado")
-    
+def build_health_status():
+    """Calcula el estado de configuración; las variables de entorno no cambian tras el arranque."""
     status = {
         "status": "healthy",
         "openai_configured": bool(os.environ.get("OPENAI_API_KEY")),
@@ -687,16 +1288,28 @@ def health_check():
         "azure_configured": bool(os.environ.get("AZURE_OPENAI_API_BASE")),
         "api_type": "responses"
     }
-    
+
     all_configured = all(status.values())
     if not all_configured:
         status["status"] = "unhealthy"
+    return status, all_configured
+
+
+HEALTH_STATUS, HEALTH_ALL_CONFIGURED = build_health_status()
+
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """Endpoint de health check para verificar el estado de la aplicación"""
+    logger.info("Health check solicitado")
+
+    if not HEALTH_ALL_CONFIGURED:
         logger.warning("Health check fallido - configuración incompleta")
-    
-    return json.dumps(status, indent=2), 200 if all_configured else 500
+
+    return jsonify(HEALTH_STATUS), 200 if HEALTH_ALL_CONFIGURED else 500
 
 @app.route('/', methods=['GET'])
-def root():
+async def root():
     """Endpoint raíz con información básica y acceso al formulario de review manual."""
     logger.info("Solicitud al endpoint raíz")
     html = """
@@ -969,12 +1582,12 @@ REVIEW_FORM_TEMPLATE = """
 
 
 @app.route("/review", methods=["GET", "POST"])
-def manual_review():
+async def manual_review():
     """Formulario sencillo de UI para generar una review pendiente a partir de un enlace de MR."""
     logger.info(f"Solicitud al endpoint /review con método {request.method}")
 
     if request.method == "GET":
-        return render_template_string(
+        return await render_template_string(
             REVIEW_FORM_TEMPLATE,
             status=None,
             status_type=None,
@@ -982,24 +1595,25 @@ def manual_review():
         ), 200
 
     # POST: procesar el formulario
-    expected_token_input = request.form.get("expected_token", "")
-    mr_url = request.form.get("mr_url", "").strip()
-    gitlab_token_from_form = request.form.get("gitlab_token", "").strip()
+    form = await request.form
+    expected_token_input = form.get("expected_token", "")
+    mr_url = form.get("mr_url", "").strip()
+    gitlab_token_from_form = form.get("gitlab_token", "").strip()
 
     configured_expected_token = os.environ.get("EXPECTED_GITLAB_TOKEN")
 
     if not configured_expected_token:
         logger.error("EXPECTED_GITLAB_TOKEN no está configurado en el entorno")
-        return render_template_string(
+        return await render_template_string(
             REVIEW_FORM_TEMPLATE,
             status="El servidor no tiene configurado EXPECTED_GITLAB_TOKEN. Revisa la configuración.",
             status_type="error",
             status_title="Configuración incompleta",
         ), 500
 
-    if expected_token_input != configured_expected_token:
+    if not tokens_match(expected_token_input, configured_expected_token):
         logger.warning("Token esperado recibido desde la UI no coincide con EXPECTED_GITLAB_TOKEN")
-        return render_template_string(
+        return await render_template_string(
             REVIEW_FORM_TEMPLATE,
             status="El token proporcionado no coincide con el token esperado. Acceso denegado.",
             status_type="error",
@@ -1008,7 +1622,7 @@ def manual_review():
 
     if not mr_url:
         logger.warning("No se proporcionó URL de MR en el formulario")
-        return render_template_string(
+        return await render_template_string(
             REVIEW_FORM_TEMPLATE,
             status="Debes proporcionar un enlace válido al Merge Request.",
             status_type="error",
@@ -1018,7 +1632,7 @@ def manual_review():
     project_path, mr_iid = extract_project_path_and_iid_from_url(mr_url)
     if project_path is None or mr_iid is None:
         logger.warning(f"No se pudo extraer project_path/IID del MR desde la URL proporcionada: {mr_url}")
-        return render_template_string(
+        return await render_template_string(
             REVIEW_FORM_TEMPLATE,
             status="No se pudo detectar el proyecto y número de MR a partir del enlace. Verifica que el enlace sea correcto.",
             status_type="error",
@@ -1028,14 +1642,13 @@ def manual_review():
     try:
         # Resolver el proyecto a partir del path del enlace del MR
         effective_gitlab_token = gitlab_token_from_form or gitlab_token
-        headers = {"Private-Token": effective_gitlab_token}
-        project_api_url = f"{gitlab_url}/projects/{requests.utils.quote(project_path, safe='')}"
+        project_api_url = f"{gitlab_url}/projects/{quote(project_path, safe='')}"
 
         logger.info(
             f"Resolviendo project_id a partir del path del proyecto de la URL del MR: "
             f"project_path='{project_path}', url={project_api_url}"
         )
-        project_resp = requests.get(project_api_url, headers=headers)
+        project_resp = await gitlab_client.get(project_api_url, headers=gitlab_headers(gitlab_token_from_form))
         logger.info(f"Respuesta de resolución de proyecto - Status: {project_resp.status_code}")
 
         if project_resp.status_code != 200:
@@ -1043,7 +1656,7 @@ def manual_review():
                 f"Error al obtener proyecto desde path '{project_path}': "
                 f"{project_resp.status_code} - {project_resp.text}"
             )
-            return render_template_string(
+            return await render_template_string(
                 REVIEW_FORM_TEMPLATE,
                 status=(
                     "No se pudo resolver el proyecto a partir del enlace del MR. "
@@ -1060,22 +1673,22 @@ def manual_review():
 
         if not project_id:
             logger.error("La respuesta de GitLab no incluye id para el proyecto resuelto")
-            return render_template_string(
+            return await render_template_string(
                 REVIEW_FORM_TEMPLATE,
                 status="No se pudo determinar el ID del proyecto del Merge Request. Revisa los logs del servidor.",
                 status_type="error",
                 status_title="Datos incompletos del MR",
             ), 500
 
-        extra_context = request.form.get("extra_context", "").strip()
-        logger.info(f"Extra context: {extra_context}")
+        extra_context = form.get("extra_context", "").strip()
+        logger.debug("Extra context: %s", extra_context)
 
-        review_body = build_ai_review_for_mr(project_id, mr_iid, extra_context or None, private_token=effective_gitlab_token)
-        create_pending_review_draft_note(project_id, mr_iid, review_body, private_token=effective_gitlab_token)
+        review_body = await build_ai_review_for_mr(project_id, mr_iid, extra_context or None, private_token=effective_gitlab_token)
+        await create_pending_review_draft_note(project_id, mr_iid, review_body, private_token=effective_gitlab_token)
         # Comentarios inline (quedan también como draft notes, en pending)
-        generate_inline_draft_notes_for_mr(project_id, mr_iid, private_token=effective_gitlab_token)
+        await generate_inline_draft_notes_for_mr(project_id, mr_iid, private_token=effective_gitlab_token)
 
-        return render_template_string(
+        return await render_template_string(
             REVIEW_FORM_TEMPLATE,
             status=(
                 f"Se generó correctamente una review pendiente para el MR !{mr_iid}, "
@@ -1088,7 +1701,7 @@ def manual_review():
 
     except Exception as e:
         logger.error(f"Error inesperado generando review manual para MR {mr_iid}: {e}")
-        return render_template_string(
+        return await render_template_string(
             REVIEW_FORM_TEMPLATE,
             status=f"Ocurrió un error al generar la review: {str(e)}",
             status_type="error",
@@ -1096,12 +1709,12 @@ def manual_review():
         ), 500
 
 @app.errorhandler(404)
-def not_found(error):
+async def not_found(error):
     logger.warning(f"Endpoint no encontrado: {request.url}")
     return "Endpoint no encontrado", 404
 
 @app.errorhandler(500)
-def internal_error(error):
+async def internal_error(error):
     logger.error(f"Error interno del servidor: {error}")
     return "Error interno del servidor", 500
 
@@ -1117,7 +1730,7 @@ if __name__ == '__main__':
     logger.info(f"  - URL: {gitlab_url}")
     logger.info(f"  - Token configurado: {'Sí' if gitlab_token else 'No'}")
     logger.info(f"  - Token esperado configurado: {'Sí' if os.environ.get('EXPECTED_GITLAB_TOKEN') else 'No'}")
-    logger.info("Iniciando servidor Flask en puerto 8080...")
+    logger.info("Iniciando servidor Quart en puerto 8080...")
     
     try:
         app.run(host='0.0.0.0', port=8080, debug=False)
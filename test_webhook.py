@@ -52,7 +52,7 @@ def test_merge_request_webhook():
         response = requests.post(WEBHOOK_URL, json=payload, headers=headers)
         print(f"Status: {response.status_code}")
         print(f"Response: {response.text}")
-        return response.status_code == 200
+        return response.status_code in (200, 202)
     except Exception as e:
         print(f"Error: {e}")
         return False
@@ -79,7 +79,7 @@ def test_push_webhook():
         response = requests.post(WEBHOOK_URL, json=payload, headers=headers)
         print(f"Status: {response.status_code}")
         print(f"Response: {response.text}")
-        return response.status_code == 200
+        return response.status_code in (200, 202)
     except Exception as e:
         print(f"Error: {e}")
         return False